@@ -1,8 +1,15 @@
+import functools
+import warnings
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional, Union
+
+try:
+    from flashinfer.gemm import fp8_blockscale_gemm_sm90
+except ImportError:
+    fp8_blockscale_gemm_sm90 = None
 
 @dataclass
 class ModelArgs:
@@ -14,15 +21,30 @@ class ModelArgs:
     multiple_of: int  = 256
     ffn_dim_multiplier: Optional[float] = None
     norm_eps: float = 1e-4
+    # share the weight of the token embeddings and the output projection
+    tie_word_embeddings: bool = False
 
     #for kv cache
     max_batch_size: int = 32 
     max_seq_len:int = 2048
 
     device: str = None
-
-def precompute_theta_pos_embeddings(head_dim: int, seq_len: int, device: str, theta: float = 10000.0):
-    assert head_dim % 2, "According to paper, must be even"
+    dtype: torch.dtype = torch.bfloat16
+    # store the kv cache in int8 with one scale per cached (batch, head, token) row, the cached rows are dequantized
+    # to a full model dtype copy before the attention: it halves the kv cache memory but not the decode bandwidth
+    kv_cache_int8: bool = False
+    # hand out the kv cache in pages of a pool shared by the batch instead of one contiguous region per sequence,
+    # off by default: there is no paged attention kernel yet, the live pages are gathered every layer and step
+    paged_kv_cache: bool = False
+    # number of tokens per page of the paged kv cache, the contiguous one is read in whole pages of that size
+    kv_page_size: int = 16
+    # compact the paged kv cache every n forward steps (0 disables it)
+    kv_compact_interval: int = 25
+    # replay the decode step with CUDA graphs (one graph per batch size and number of kv pages)
+    use_cuda_graphs: bool = False
+
+def precompute_theta_pos_embeddings(head_dim: int, seq_len: int, device: str, theta: float = 10000.0, dtype: torch.dtype = torch.float32):
+    assert head_dim % 2 == 0, "According to paper, must be even"
     # formula =>  theta_i = 10000^(-2(i-1)/dim), i = [1, 2, ... dim/2]
     #acc to paper, Shape: (head_dim / 2)
     theta_numerator = torch.arange(0, head_dim,2).float()
@@ -34,47 +56,145 @@ def precompute_theta_pos_embeddings(head_dim: int, seq_len: int, device: str, th
     # multiply each theta by each position using the outer product
     # shape : (seq_len) outer product (head_dim) -> (seq_len, head_dim/2)
     freqs = torch.outer(m, theta).float()
-    # We can compute complex number in polar form c = R * exp(i * m * theta), where R = 1 as follows:
-    # shape: (seq_len, head_dim/2) -> (seq_len, head_dim/2)
-    freqs_complex = torch.polar(torch.ones_like(freqs), freqs)
-    return freqs_complex
-
-def apply_rotary_embeddings(x: torch.Tensor, freqs_complex: torch.Tensor, device: str):
-    # (batch_size, seq_len, H, dim) -> (batch_size, seq_len, H, dim / 2)
-    x_complex = torch.view_as_complex(x.float().reshape(*x.shape[:-1], -1, 2))
-    # (seq_len, head_dim / 2) -> (1, seq_len, 1, head_dim / 2)
-    freqs_complex = torch.unsqueeze(0).unsqueeze(2)
-    # (batch_size, seq_len, H, dim / 2) * (1, seq_len, 1, head_dim / 2) = (B, seq_len, H, head_dim/2)
-    x_rotated = x_complex * freqs_complex
+    # the rotation by m * theta is kept as real cos / sin tables (instead of complex numbers) in the model dtype
+    # shape: (seq_len, head_dim/2), (seq_len, head_dim/2)
+    freqs_cos = torch.cos(freqs).to(dtype)
+    freqs_sin = torch.sin(freqs).to(dtype)
+    return freqs_cos, freqs_sin
+
+def apply_rotary_embeddings(x: torch.Tensor, freqs_cos: torch.Tensor, freqs_sin: torch.Tensor):
+    # (batch_size, seq_len, H, head_dim) -> (batch_size, seq_len, H, head_dim/2, 2)
+    x_pairs = x.reshape(*x.shape[:-1], -1, 2)
+    # (batch_size, seq_len, H, head_dim/2)
+    x1 = x_pairs[..., 0]
+    x2 = x_pairs[..., 1]
+    # (batch_size, seq_len, head_dim / 2) -> (batch_size, seq_len, 1, head_dim / 2)
+    freqs_cos = freqs_cos.unsqueeze(2)
+    freqs_sin = freqs_sin.unsqueeze(2)
+    # rotate each pair (x1, x2) by m * theta, same as the complex product (x1 + i*x2) * exp(i * m * theta)
     # (batch_size, seq_len, H, head_dim/2) -> (batch_size, seq_len, H, head_dim/2, 2)
-    x_out = torch.view_as_real(x_rotated)
+    x_out = torch.stack((x1 * freqs_cos - x2 * freqs_sin, x1 * freqs_sin + x2 * freqs_cos), dim=-1)
     # (batch_size, seq_len, H, head_dim/2, 2) -> (B, seq_len, H, Head_dim)
-    x_out = x_out.reshape(*x.shape)
-    return x_out.type_as(x).to(device)
-
-def repeat_kv(x: torch.Tensor, n_rep: int):
-    batch_size, seq_len, n_kv_heads, head_dim = x.shape
-    if n_rep == 1:
-        return x
-    else: 
-        return (
-            x[:, :, :, None, :]
-            .expand(batch_size, seq_len, n_kv_heads, n_rep, head_dim)
-            .reshape(batch_size, seq_len, n_kv_heads * n_rep, head_dim)
-        )
-
+    return x_out.reshape(*x.shape)
+
+def quantize_kv(x: torch.Tensor):
+    # symmetric int8 quantization over head_dim
+    # (B, H, seq_len, head_dim) -> (B, H, seq_len, head_dim) int8, (B, H, seq_len) float16
+    scale = (x.abs().amax(dim=-1).float() / 127.0).clamp(min=1e-6).to(torch.float16)
+    x_q = (x.float() / scale.float().unsqueeze(-1)).round().clamp(-127, 127).to(torch.int8)
+    return x_q, scale
+
+def dequantize_kv(x_q: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype):
+    # (B, H, seq_len, head_dim) int8, (B, H, seq_len) -> (B, H, seq_len, head_dim)
+    return x_q.to(dtype) * scale.to(dtype).unsqueeze(-1)
+
+def compile_or_eager(fn):
+    # fuse fn with torch.compile, if the compilation fails (no Inductor backend, no C++ compiler or triton on the
+    # machine, ...) fn keeps running eagerly, the choice is made once on the first call
+    compiled = torch.compile(fn, dynamic=True)
+    impl = None
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        nonlocal impl
+        if impl is None:
+            try:
+                output = compiled(*args)
+                impl = compiled
+                return output
+            except Exception as e:
+                warnings.warn(f"torch.compile is unavailable for {fn.__name__}, running it eagerly: {e}")
+                impl = fn
+        return impl(*args)
+    return wrapper
+
+@compile_or_eager
+def rms_norm(x: torch.Tensor, weight: torch.Tensor, eps: float):
+    # compiled into a single kernel: x is read once and the sum of squares is accumulated in float32
+    x_fp32 = x.float()
+    return weight * (x_fp32 * torch.rsqrt(x_fp32.pow(2).mean(-1, keepdim= True) + eps)).type_as(x)
 
 class RMSNorm(nn.Module):
-    def __init__(self, dim: int, eps: float = 1e-6):
+    def __init__(self, dim: int, eps: float = 1e-6, device: str = None, dtype: torch.dtype = None):
         super().__init__()
         self.eps = eps
-        self.weight = nn.Parameter(torch.ones(dim))
-
-    def _norm(self, x: torch.Tensor):
-        return x * torch.rsqrt(x.pow(2).mean(-1, keepdim= True) + self.eps)
+        # kept in the model dtype rather than float32: it scales the normalized x after it is cast back to the dtype
+        # of x (as in the reference Llama implementation), there is no per call cast of the weight to save and a
+        # float32 weight would promote the output of every norm to float32
+        self.weight = nn.Parameter(torch.ones(dim, device=device, dtype=dtype))
 
     def forward(self, x:torch.Tensor):
-        return self.weight * self._norm(x.float()).type_as(x)
+        return rms_norm(x, self.weight, self.eps)
+
+class Fp8Linear(nn.Module):
+    # weight only float8 (e4m3) linear layer with one float32 scale per 128 x 128 block of the weight
+    block_size = 128
+
+    def __init__(self, in_features: int, out_features: int, device: str = None) -> None:
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        n_blocks_out = (out_features + self.block_size - 1) // self.block_size
+        n_blocks_in = (in_features + self.block_size - 1) // self.block_size
+        self.register_buffer("weight", torch.zeros((out_features, in_features), dtype=torch.float8_e4m3fn, device=device))
+        self.register_buffer("weight_scale", torch.ones((n_blocks_out, n_blocks_in), dtype=torch.float32, device=device))
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear: nn.Linear):
+        weight = linear.weight.float()
+        out_features, in_features = weight.shape
+        layer = cls(in_features, out_features, device=weight.device)
+        n_blocks_out, n_blocks_in = layer.weight_scale.shape
+        # (out, in) -> (n_blocks_out, block_size, n_blocks_in, block_size), padded with zeros to whole blocks
+        blocks = F.pad(weight, (0, n_blocks_in * cls.block_size - in_features, 0, n_blocks_out * cls.block_size - out_features))
+        blocks = blocks.view(n_blocks_out, cls.block_size, n_blocks_in, cls.block_size)
+        # (n_blocks_out, n_blocks_in)
+        scale = blocks.abs().amax(dim=(1, 3)).clamp(min=1e-12) / torch.finfo(torch.float8_e4m3fn).max
+        blocks = blocks / scale[:, None, :, None]
+        layer.weight.copy_(blocks.view(n_blocks_out * cls.block_size, -1)[:out_features, :in_features].to(torch.float8_e4m3fn))
+        layer.weight_scale.copy_(scale)
+        return layer
+
+    def dequantize(self, dtype: torch.dtype):
+        # a single weight sized temporary in dtype, the block scales are broadcast over a blocked view of it
+        n_blocks_out, n_blocks_in = self.weight_scale.shape
+        weight = self.weight.to(dtype)
+        if (n_blocks_out * self.block_size, n_blocks_in * self.block_size) != weight.shape:
+            weight = F.pad(weight, (0, n_blocks_in * self.block_size - self.in_features, 0, n_blocks_out * self.block_size - self.out_features))
+        # (out, in) -> (n_blocks_out, block_size, n_blocks_in, block_size) * (n_blocks_out, 1, n_blocks_in, 1)
+        weight = weight.view(n_blocks_out, self.block_size, n_blocks_in, self.block_size)
+        weight.mul_(self.weight_scale.to(dtype)[:, None, :, None])
+        return weight.view(n_blocks_out * self.block_size, n_blocks_in * self.block_size)[:self.out_features, :self.in_features]
+
+    def forward(self, x: torch.Tensor):
+        if fp8_blockscale_gemm_sm90 is not None and x.is_cuda and x.dtype == torch.bfloat16 and torch.cuda.get_device_capability(x.device)[0] == 9:
+            # Hopper block scaled fp8 GEMM, the activations stay in bf16
+            # (B, seq_len, in) -> (B * seq_len, in) -> (B * seq_len, out) -> (B, seq_len, out)
+            output = fp8_blockscale_gemm_sm90(x.reshape(-1, self.in_features), self.weight, None, self.weight_scale)
+            return output.view(*x.shape[:-1], self.out_features)
+        return F.linear(x, self.dequantize(x.dtype))
+
+def quantize_linears_fp8(model: nn.Module):
+    # replace every nn.Linear of the model with an Fp8Linear, to be called once after the weights are loaded,
+    # a Linear sharing its weight with an embedding (tie_word_embeddings) is kept as is so the weights stay tied
+    tied_weights = {id(module.weight) for module in model.modules() if isinstance(module, nn.Embedding)}
+    for parent in list(model.modules()):
+        for name, module in list(parent.named_children()):
+            if isinstance(module, nn.Linear) and id(module.weight) not in tied_weights:
+                setattr(parent, name, Fp8Linear.from_linear(module))
+    return model
+
+def linear_into(linear: nn.Module, x: torch.Tensor, buffer: torch.Tensor):
+    # x @ W^T written into a preallocated (max_batch_size, 1, out_features) buffer instead of a fresh tensor, the
+    # output is a view of the buffer and is overwritten by the next call with the same buffer,
+    # other shapes / dtypes and layers that are not a plain nn.Linear (e.g. Fp8Linear) go through the module call
+    batch_size, seq_len, _ = x.shape
+    if type(linear) is not nn.Linear or seq_len != buffer.shape[1] or x.dtype != buffer.dtype or x.device != buffer.device:
+        return linear(x)
+    output = buffer[:batch_size]
+    torch.matmul(x, linear.weight.t(), out=output)
+    return output
 
 class SelfAttention(nn.Module):
     def __init__(self, args: ModelArgs) -> None:
@@ -86,21 +206,89 @@ class SelfAttention(nn.Module):
         self.n_rep = self.n_heads_q // self.n_kv_heads
         self.head_dim = args.dim // args.n_heads
         
-        self.wq = nn.Linear(args.dim, args.n_heads * self.head_dim, bias=False)
-        self.wk = nn.Linear(args.dim, args.n_kv_heads * self.head_dim, bias=False)
-        self.wv = nn.Linear(args.dim, args.n_kv_heads * self.head_dim, bias=False)
-        self.wo = nn.Linear(args.n_heads * self.head_dim, args.dim, bias=False)
-
-        self.cache_k = torch.zeros((args.max_batch_size, args.max_seq_len, self.n_kv_heads, self.head_dim))
-        self.cache_v = torch.zeros((args.max_batch_size, args.max_seq_len, self.n_kv_heads, self.head_dim))
-
-    def forward(self, x: torch.Tensor, start_pos: int, freq_complex: torch.Tensor):
+        # wq, wk and wv merged into one projection, rows are stacked in the order q, k, v
+        self.wqkv = nn.Linear(args.dim, (self.n_heads_q + 2 * self.n_kv_heads) * self.head_dim, bias=False, device=args.device, dtype=args.dtype)
+        self.wo = nn.Linear(args.n_heads * self.head_dim, args.dim, bias=False, device=args.device, dtype=args.dtype)
+
+        # outputs of the projections for a decode step, reused every step instead of being allocated
+        self.register_buffer("qkv_buf", torch.empty((args.max_batch_size, 1, (self.n_heads_q + 2 * self.n_kv_heads) * self.head_dim), dtype=args.dtype, device=args.device), persistent=False)
+        self.register_buffer("attn_out_buf", torch.empty((args.max_batch_size, 1, args.dim), dtype=args.dtype, device=args.device), persistent=False)
+
+        # layout of the rows of this layer in the paged kv cache (owned by Transformers)
+        self.cache_dtype = torch.int8 if args.kv_cache_int8 else args.dtype
+        # cached rows never straddle a 256 byte boundary (coalesced loads): rows under 256 bytes are padded to the next
+        # power of two (a divisor of 256), longer rows to a multiple of 256 bytes, the padding after head_dim is sliced
+        # off before the cache is read
+        dtype_bytes = torch.empty(0, dtype=self.cache_dtype).element_size()
+        row_bytes = self.head_dim * dtype_bytes
+        if row_bytes < 256:
+            cache_row_bytes = 1 << (row_bytes - 1).bit_length()
+        else:
+            cache_row_bytes = ((row_bytes + 255) // 256) * 256
+        self.cache_head_dim = cache_row_bytes // dtype_bytes
+
+    def _write_kv(self, xk: torch.Tensor, xv: torch.Tensor, input_pos: torch.Tensor, kv_cache: torch.Tensor, kv_cache_scale: Optional[torch.Tensor], block_table: Optional[torch.Tensor]):
+        # (B, H_KV, seq_len, head_dim)
+        if block_table is None:
+            # contiguous kv cache: row of the sequence and slot of every new token: (B, 1), (B, seq_len)
+            blocks = torch.arange(input_pos.shape[0], device=input_pos.device)[:, None]
+            offsets = input_pos
+        else:
+            page_size = self.args.kv_page_size
+            # physical page and slot in the page of every new token: (B, seq_len), (B, seq_len)
+            blocks = block_table.gather(1, input_pos // page_size)
+            offsets = input_pos % page_size
+        if self.args.kv_cache_int8:
+            xk, xk_scale = quantize_kv(xk)
+            xv, xv_scale = quantize_kv(xv)
+            # (B, H_KV, seq_len) -> (B, seq_len, H_KV)
+            kv_cache_scale[:, 0][blocks, :, offsets] = xk_scale.transpose(1, 2)
+            kv_cache_scale[:, 1][blocks, :, offsets] = xv_scale.transpose(1, 2)
+        # (B, H_KV, seq_len, head_dim) -> (B, seq_len, H_KV, head_dim)
+        kv_cache[:, 0][blocks, :, offsets, :self.head_dim] = xk.transpose(1, 2).to(kv_cache.dtype)
+        kv_cache[:, 1][blocks, :, offsets, :self.head_dim] = xv.transpose(1, 2).to(kv_cache.dtype)
+
+    def _read_kv(self, kv_cache: torch.Tensor, kv_cache_scale: Optional[torch.Tensor], block_table: Optional[torch.Tensor], dtype: torch.dtype):
+        # the cache is read up to the last live page of the batch, the slots past the current position are
+        # sliced off or masked out by the caller
+        if block_table is None:
+            # contiguous kv cache, already narrowed to the rows of the batch by the caller: the attention reads a view
+            # of it and nothing is copied (the row padding past head_dim is skipped by the strides)
+            # (B, H_KV, n_pages * page_size, cache_head_dim) -> (B, H_KV, n_pages * page_size, head_dim)
+            keys = kv_cache[:, 0, ..., :self.head_dim]
+            values = kv_cache[:, 1, ..., :self.head_dim]
+            if self.args.kv_cache_int8:
+                # (B, H_KV, n_pages * page_size)
+                keys_scale = kv_cache_scale[:, 0]
+                values_scale = kv_cache_scale[:, 1]
+        else:
+            # block_table only holds the live pages (B, n_pages)
+            batch_size, n_pages = block_table.shape
+            page_size = self.args.kv_page_size
+            # (B, 1, n_pages), (1, H_KV, 1)
+            blocks = block_table[:, None, :]
+            heads = torch.arange(self.n_kv_heads, device=block_table.device)[None, :, None]
+            # gather the live pages of every sequence in one pass (there is no paged attention kernel yet),
+            # the row padding past head_dim is sliced off before the gather so it is never copied
+            # (B, H_KV, n_pages, page_size, head_dim) -> (B, H_KV, n_pages * page_size, head_dim)
+            keys = kv_cache[:, 0, ..., :self.head_dim][blocks, heads].view(batch_size, self.n_kv_heads, n_pages * page_size, self.head_dim)
+            values = kv_cache[:, 1, ..., :self.head_dim][blocks, heads].view(batch_size, self.n_kv_heads, n_pages * page_size, self.head_dim)
+            if self.args.kv_cache_int8:
+                # (B, H_KV, n_pages, page_size) -> (B, H_KV, n_pages * page_size)
+                keys_scale = kv_cache_scale[:, 0][blocks, heads].view(batch_size, self.n_kv_heads, -1)
+                values_scale = kv_cache_scale[:, 1][blocks, heads].view(batch_size, self.n_kv_heads, -1)
+        if self.args.kv_cache_int8:
+            keys = dequantize_kv(keys, keys_scale, dtype)
+            values = dequantize_kv(values, values_scale, dtype)
+        return keys, values
+
+    def forward(self, x: torch.Tensor, input_pos: torch.Tensor, freqs_cos: torch.Tensor, freqs_sin: torch.Tensor, kv_cache: torch.Tensor, kv_cache_scale: Optional[torch.Tensor], block_table: Optional[torch.Tensor], seq_len_kv: Optional[int]):
+        # for a decode step the output is a view of attn_out_buf: it is only valid until the next call of this layer,
+        # the caller has to consume it (EncoderBlock adds it to the residual stream right away) or clone it
         batch_size, seq_len, _ = x.shape # (B, 1, dim)
 
-        # (B, 1, dim) -> (B, 1, H_Q * head_dim)
-        xq = self.wq(x)
-        xk = self.wk(x)
-        xv = self.wv(x)
+        # (B, 1, dim) -> (B, 1, (H_Q + 2 * H_KV) * head_dim) -> (B, 1, H_Q * head_dim), (B, 1, H_KV * head_dim), (B, 1, H_KV * head_dim)
+        xq, xk, xv = linear_into(self.wqkv, x, self.qkv_buf).split([self.n_heads_q * self.head_dim, self.n_kv_heads * self.head_dim, self.n_kv_heads * self.head_dim], dim=-1)
 
         # (B, 1, H_Q * head_dim) -> (B, 1, H_Q, head_dim)
         xq = xq.view(batch_size, seq_len, self.n_heads_q, self.head_dim)
@@ -108,37 +296,50 @@ class SelfAttention(nn.Module):
         xv = xv.view(batch_size, seq_len, self.n_kv_heads, self.head_dim)
 
         # applying RoPE (no change in shape of tensor)
-        xq = apply_rotary_embeddings(xq, freq_complex, device = x.device)
-        xk = apply_rotary_embeddings(xk, freq_complex, device = x.device)
-
-        #replace the entry in cache for token
-        self.cache_k[:batch_size, start_pos:start_pos + seq_len] = xk
-        self.cache_v[:batch_size, start_pos:start_pos + seq_len] = xv
+        xq = apply_rotary_embeddings(xq, freqs_cos, freqs_sin)
+        xk = apply_rotary_embeddings(xk, freqs_cos, freqs_sin)
 
-        #retrieve all the cached keys and values 
-        keys = self.cache_k[:batch_size, 0:start_pos + seq_len]
-        values = self.cache_v[:batch_size, 0:start_pos + seq_len]
-
-        # repeat the heads of K and V to reach the number of head of queries
-        keys = repeat_kv(keys, self.n_rep)
-        values = repeat_kv(values, self.n_rep)
-
-        # (B, 1, H_Q, head_dim) -> (B, H_Q, 1, head_dim)
+        # (B, 1, H, head_dim) -> (B, H, 1, head_dim)
         xq = xq.transpose(1, 2)
-        keys = keys.transpose(1,2)
-        values = values.transpose(1,2)
+        xk = xk.transpose(1, 2)
+        xv = xv.transpose(1, 2)
 
-        # (B, H_Q, 1, head_dim) @ (B, H_Q, head_dim, seq_len_kv) -> (B, H_Q, 1, seq_len_kv)
-        scores = torch.matmul(xq, keys.transpose(2,3)) / torch.sqrt(self.head_dim)
-        scores = F.softmax(scores.float(), dim = -1).type_as(xq)
-
-        # (B, H_Q, 1, seq_len_kv) @ (B, H_Q, seq_len_kv, head_dim) -> (B, H_Q, 1, head_dim)
-        output = torch.matmul(scores, values)
+        #replace the entry in cache for token
+        self._write_kv(xk, xv, input_pos, kv_cache, kv_cache_scale, block_table)
+
+        #retrieve all the cached keys and values
+        # (B, H_KV, n_pages * page_size, head_dim)
+        keys, values = self._read_kv(kv_cache, kv_cache_scale, block_table, xq.dtype)
+        if seq_len_kv is not None:
+            # (B, H_KV, seq_len_kv, head_dim), no mask so SDPA can pick the flash attention kernel
+            keys = keys[:, :, :seq_len_kv]
+            values = values[:, :, :seq_len_kv]
+            mask = None
+        else:
+            # sequences at different positions or CUDA graph capture, every sequence only attends its cached tokens
+            # up to its own position, shape: (B, 1, 1, n_pages * page_size)
+            mask = (torch.arange(keys.shape[2], device=keys.device)[None, :] <= input_pos[:, -1:]).view(batch_size, 1, 1, -1)
+
+        # grouped query attention without repeating the KV heads: the n_rep query heads sharing a KV head
+        # are folded into the query length, so each KV head is read once for its whole group
+        # (B, H_Q, 1, head_dim) -> (B, H_KV, n_rep * 1, head_dim)
+        xq = xq.reshape(batch_size, self.n_kv_heads, self.n_rep * seq_len, self.head_dim)
+
+        # fused attention kernel
+        # (B, H_KV, n_rep * 1, head_dim) x (B, H_KV, seq_len_kv, head_dim) -> (B, H_KV, n_rep * 1, head_dim)
+        output = F.scaled_dot_product_attention(xq, keys, values, attn_mask=mask)
+        # (B, H_KV, n_rep * 1, head_dim) -> (B, H_Q, 1, head_dim)
+        output = output.view(batch_size, self.n_heads_q, seq_len, self.head_dim)
 
         # (B, H_Q, 1, head_dim) -> (B, 1, H_Q, head_dim) -> (B, 1, Dim)
-        output = (output.transpose(1,2).contiguous().view(batch_size, seq_len, -1))
-        return self.wo(output) # (B, 1, Dim) -> (B, 1, Dim)
+        output = output.transpose(1, 2).reshape(batch_size, seq_len, -1)
+        return linear_into(self.wo, output, self.attn_out_buf) # (B, 1, Dim) -> (B, 1, Dim)
     
+@compile_or_eager
+def swiglu(x_w1: torch.Tensor, x_v: torch.Tensor):
+    # compiled into a single kernel reading both projections once
+    return F.silu(x_w1) * x_v
+
 class FeedForward(nn.Module):
     def __init__(self, args: ModelArgs):
         super().__init__()    
@@ -150,15 +351,21 @@ class FeedForward(nn.Module):
         # round the hidden dim to nearest multiple of the multiple_of parameter
         hidden = args.multiple_of * ((hidden_dim + args.multiple_of - 1) // args.multiple_of)
 
-        self.w1 = nn.Linear(args.dim, hidden_dim, bias=False)
-        self.w2 = nn.Linear(hidden_dim, args.dim, bias=False)
-        self.w3 = nn.Linear(args.dim, hidden_dim, bias=False)
+        # w1 and w3 merged into one projection, rows [:hidden_dim] are w1 and rows [hidden_dim:] are w3
+        self.w13 = nn.Linear(args.dim, 2 * hidden_dim, bias=False, device=args.device, dtype=args.dtype)
+        self.w2 = nn.Linear(hidden_dim, args.dim, bias=False, device=args.device, dtype=args.dtype)
+
+        # outputs of the projections for a decode step, reused every step instead of being allocated
+        self.register_buffer("w13_buf", torch.empty((args.max_batch_size, 1, 2 * hidden_dim), dtype=args.dtype, device=args.device), persistent=False)
+        self.register_buffer("ffn_out_buf", torch.empty((args.max_batch_size, 1, args.dim), dtype=args.dtype, device=args.device), persistent=False)
 
     def forward(self, x: torch.Tensor):
-        swish = F.silu(self.w1(x))
-        x_v = self.w3(x)
-        x = x_v * swish  
-        x = self.w2(x) 
+        # for a decode step the output is a view of ffn_out_buf: it is only valid until the next call of this layer,
+        # the caller has to consume it (EncoderBlock adds it to the residual stream right away) or clone it
+        # (B, seq_len, dim) -> (B, seq_len, hidden_dim), (B, seq_len, hidden_dim)
+        x_w1, x_v = linear_into(self.w13, x, self.w13_buf).chunk(2, dim=-1)
+        x = swiglu(x_w1, x_v)
+        x = linear_into(self.w2, x, self.ffn_out_buf) 
         return x  
     
 class EncoderBlock(nn.Module):
@@ -169,17 +376,17 @@ class EncoderBlock(nn.Module):
         self.dim = args.dim
         self.head_dim = args.dim // args.n_heads
 
-        self.attention = SelfAttention()
-        self.feed_forward = FeedForward()
+        self.attention = SelfAttention(args)
+        self.feed_forward = FeedForward(args)
 
         #normalization before attention
-        self.attention_norm = RMSNorm(args.dim, eps =args.norm_eps)
+        self.attention_norm = RMSNorm(args.dim, eps =args.norm_eps, device=args.device, dtype=args.dtype)
         #normalization before feed forward block
-        self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
+        self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps, device=args.device, dtype=args.dtype)
       
-    def forward(self, x:torch.Tensor, start_pos: int, freqs_complex: torch.Tensor):
+    def forward(self, x:torch.Tensor, input_pos: torch.Tensor, freqs_cos: torch.Tensor, freqs_sin: torch.Tensor, kv_cache: torch.Tensor, kv_cache_scale: Optional[torch.Tensor], block_table: Optional[torch.Tensor], seq_len_kv: Optional[int]):
         # (B, seq_len, dim) + (B, seq_len, dim) -> (B, seq_len, dim)
-        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_complex)
+        h = x + self.attention.forward(self.attention_norm(x), input_pos, freqs_cos, freqs_sin, kv_cache, kv_cache_scale, block_table, seq_len_kv)
         out = h + self.feed_forward.forward(self.ffn_norm(x))
         return out
 
@@ -190,35 +397,181 @@ class Transformers(nn.Module):
         self.args = args
         self.vocab_size = args.vocab_size
         self.n_layers = args.n_layers
-        self.tok_embeddings = nn.Embedding(self.vocab_size, args.dim)
+        # parameters are created in the model dtype, the same as the kv cache and rope tables
+        self.tok_embeddings = nn.Embedding(self.vocab_size, args.dim, device=args.device, dtype=args.dtype)
 
         self.layers = nn.ModuleList()
         for _ in range(args.n_layers):
             self.layers.append(EncoderBlock(args))
 
-        self.norm = RMSNorm(args.dim, eps = args.norm_eps)  
-
-        self.output = nn.Linear(args.dim, self.vocab_size, bias = False)
-
-        self.freqs_complex = precompute_theta_pos_embeddings(self.args.dim // self.args.n_heads, self.args.max_seq_len * 2, device = self.args.device)
-
-    def forward(self, tokens: torch.Tensor, start_pos: int):
+        self.norm = RMSNorm(args.dim, eps = args.norm_eps, device = args.device, dtype = args.dtype)
+
+        self.output = nn.Linear(args.dim, self.vocab_size, bias = False, device = args.device, dtype = args.dtype)
+        if args.tie_word_embeddings:
+            self.output.weight = self.tok_embeddings.weight
+
+        # registered as (non persistent) buffers so the tables follow module.to(device)
+        freqs_cos, freqs_sin = precompute_theta_pos_embeddings(self.args.dim // self.args.n_heads, self.args.max_seq_len * 2, device = self.args.device, dtype = self.args.dtype)
+        self.register_buffer("freqs_cos", freqs_cos, persistent=False)
+        self.register_buffer("freqs_sin", freqs_sin, persistent=False)
+
+        attention = self.layers[0].attention
+        self.max_pages_per_seq = (args.max_seq_len + args.kv_page_size - 1) // args.kv_page_size
+        if args.paged_kv_cache:
+            # paged kv cache shared by all the layers, pages are handed out to the sequences of the batch on demand
+            # shape: (n_pages, n_layers, 2 (k / v), H_KV, page_size, cache_head_dim)
+            n_pages = args.max_batch_size * self.max_pages_per_seq
+            kv_cache_shape = (n_pages, args.n_layers, 2, attention.n_kv_heads, args.kv_page_size)
+            # logical page -> physical page of every sequence of the batch
+            block_table = torch.zeros((args.max_batch_size, self.max_pages_per_seq), dtype=torch.long, device=args.device)
+        else:
+            # one contiguous region per sequence of the batch, shared by all the layers
+            # shape: (max_batch_size, n_layers, 2 (k / v), H_KV, max_seq_len, cache_head_dim)
+            n_pages = 0
+            kv_cache_shape = (args.max_batch_size, args.n_layers, 2, attention.n_kv_heads, args.max_seq_len)
+            block_table = None
+        self.register_buffer("kv_cache", torch.zeros((*kv_cache_shape, attention.cache_head_dim), dtype=attention.cache_dtype, device=args.device), persistent=False)
+        kv_cache_scale = None
+        if args.kv_cache_int8:
+            kv_cache_scale = torch.zeros(kv_cache_shape, dtype=torch.float16, device=args.device)
+        self.register_buffer("kv_cache_scale", kv_cache_scale, persistent=False)
+        self.register_buffer("block_table", block_table, persistent=False)
+        self.free_pages = list(reversed(range(n_pages)))
+        self.seq_pages = [[] for _ in range(args.max_batch_size)]
+        # number of valid tokens cached for every sequence of the batch
+        self.seq_valid_len = [0] * args.max_batch_size
+        self.n_steps = 0
+
+        # captured decode steps: (batch_size, n_pages) -> (graph, static tokens, static input_pos, static output)
+        self.cuda_graphs = {}
+        self.cuda_graph_pool = None
+
+    def _allocate_kv_pages(self, seq_lens_kv: List[int]):
+        # make sure every sequence of the batch owns enough pages to hold its seq_len_kv tokens
+        for batch_idx, seq_len_kv in enumerate(seq_lens_kv):
+            n_pages = (seq_len_kv + self.args.kv_page_size - 1) // self.args.kv_page_size
+            pages = self.seq_pages[batch_idx]
+            while len(pages) < n_pages:
+                assert len(self.free_pages) > 0, "The kv cache is full"
+                page = self.free_pages.pop()
+                self.block_table[batch_idx, len(pages)] = page
+                pages.append(page)
+
+    def free_kv_cache(self, batch_idx: int):
+        # evict a finished sequence, a new sequence can take the row mid-batch (starting from start_pos 0 for that row,
+        # the stale entries of the row or of reused pages are never attended), with the paged kv cache its pages go
+        # back to the pool
+        self.seq_valid_len[batch_idx] = 0
+        if self.args.paged_kv_cache:
+            self.free_pages.extend(self.seq_pages[batch_idx])
+            self.seq_pages[batch_idx] = []
+            self.block_table[batch_idx] = 0
+
+    def compact_kv_cache(self):
+        # release the pages past the valid length of every sequence (e.g. after it restarted from an earlier position),
+        # no page is moved and the block table is left as is: its entries past the valid pages are never attended
+        page_size = self.args.kv_page_size
+        for batch_idx, pages in enumerate(self.seq_pages):
+            n_valid_pages = (self.seq_valid_len[batch_idx] + page_size - 1) // page_size
+            self.free_pages.extend(pages[n_valid_pages:])
+            del pages[n_valid_pages:]
+
+    @torch.inference_mode()
+    def forward(self, tokens: torch.Tensor, start_pos: Union[int, List[int]]):
         #(B, Seq_Len)
         batch_size, seq_len = tokens.shape
         assert seq_len == 1, "Only one token at a time can be processed"
+        # every sequence of the batch can be at its own position (continuous batching)
+        if isinstance(start_pos, int):
+            start_pos = [start_pos] * batch_size
+        assert len(start_pos) == batch_size, "One start_pos per sequence of the batch"
+        seq_lens_kv = [pos + seq_len for pos in start_pos]
+
+        self.n_steps += 1
+        if self.args.paged_kv_cache:
+            if self.args.kv_compact_interval > 0 and self.n_steps % self.args.kv_compact_interval == 0:
+                self.compact_kv_cache()
+            self._allocate_kv_pages(seq_lens_kv)
+        self.seq_valid_len[:batch_size] = seq_lens_kv
+        n_pages = (max(seq_lens_kv) + self.args.kv_page_size - 1) // self.args.kv_page_size
+
+        # positions [start_pos, start_pos + seq_len) of every sequence as a tensor, so a captured graph can be replayed
+        # at any position, shape: (B, seq_len)
+        input_pos = torch.tensor(start_pos, device=tokens.device)[:, None] + torch.arange(seq_len, device=tokens.device)
+        if self.args.use_cuda_graphs and tokens.is_cuda:
+            return self._forward_cuda_graph(tokens, input_pos, n_pages)
+        # when all the sequences are at the same position the keys are sliced to that length instead of masked
+        seq_len_kv = seq_lens_kv[0] if len(set(seq_lens_kv)) == 1 else None
+        return self._forward(tokens, input_pos, n_pages, seq_len_kv)
+
+    def _forward(self, tokens: torch.Tensor, input_pos: torch.Tensor, n_pages: int, seq_len_kv: Optional[int] = None):
+        # seq_len_kv is None when the sequences are at different positions or when capturing a CUDA graph,
+        # the attention then masks the keys past input_pos of every sequence
+        batch_size, seq_len = tokens.shape
 
         #(B, Seq_Len) -> (B, Seq_Len, dim)
         h = self.tok_embeddings(tokens)
 
-        # retrieve the pairs (m, theta) coressponding to the position [start_pos, start_pos + seq_len]
-        freqs_complex = self.freqs_complex[start_pos: start_pos + seq_len]
+        # retrieve the pairs (m, theta) coressponding to the position [start_pos, start_pos + seq_len] of every sequence
+        # shape: (B, seq_len, head_dim/2)
+        freqs_cos = self.freqs_cos[input_pos]
+        freqs_sin = self.freqs_sin[input_pos]
+
+        kv_cache, kv_cache_scale, block_table = self.kv_cache, self.kv_cache_scale, None
+        if self.args.paged_kv_cache:
+            block_table = self.block_table[:batch_size, :n_pages]
+        else:
+            # the rows of the batch up to their last live page, as a view
+            # (B, n_layers, 2, H_KV, n_pages * page_size, cache_head_dim)
+            kv_len = n_pages * self.args.kv_page_size
+            kv_cache = kv_cache[:batch_size, :, :, :, :kv_len]
+            if kv_cache_scale is not None:
+                kv_cache_scale = kv_cache_scale[:batch_size, :, :, :, :kv_len]
 
         #Consecutively apply to all layers
-        for layer in self.layers:
-            h = layer(h, start_pos, freqs_complex)
+        for layer_id, layer in enumerate(self.layers):
+            layer_kv_cache_scale = kv_cache_scale[:, layer_id] if kv_cache_scale is not None else None
+            h = layer(h, input_pos, freqs_cos, freqs_sin, kv_cache[:, layer_id], layer_kv_cache_scale, block_table, seq_len_kv)
         h = self.norm(h)
-        output = self.output(h).float()
-        return output    
-    
-
-
+        # logits are kept in the model dtype, only the few sampled candidates are upcast (see sample_top_k)
+        output = self.output(h)
+        return output
+
+    def _forward_cuda_graph(self, tokens: torch.Tensor, input_pos: torch.Tensor, n_pages: int):
+        # the shapes of a decode step only change with the batch size and the number of kv pages,
+        # the position reaches the graph through input_pos and the pages through the block table buffer
+        key = (tokens.shape[0], n_pages)
+        if key not in self.cuda_graphs:
+            static_tokens = tokens.clone()
+            static_input_pos = input_pos.clone()
+            # warm up on a side stream before capturing (compiles the torch.compile kernels, sets up cuBLAS),
+            # it writes the same kv entries as the replay below
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                self._forward(static_tokens, static_input_pos, n_pages)
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph, pool=self.cuda_graph_pool):
+                static_output = self._forward(static_tokens, static_input_pos, n_pages)
+            self.cuda_graph_pool = graph.pool()
+            self.cuda_graphs[key] = (graph, static_tokens, static_input_pos, static_output)
+
+        graph, static_tokens, static_input_pos, static_output = self.cuda_graphs[key]
+        static_tokens.copy_(tokens)
+        static_input_pos.copy_(input_pos)
+        graph.replay()
+        # the graphs share one memory pool, the logits are only valid until the next forward call
+        return static_output
+
+def sample_top_k(logits: torch.Tensor, temperature: float = 0.6, top_k: int = 50):
+    # the logits of the last position are sampled: (B, seq_len, vocab_size) as returned by forward -> (B, vocab_size)
+    if logits.dim() == 3:
+        logits = logits[:, -1]
+    # (B, vocab_size) -> (B, top_k), the top_k selection runs on the model dtype logits
+    top_k_logits, top_k_idx = logits.topk(top_k, dim=-1)
+    # only the top_k logits are upcast to float32 for the softmax
+    probs = torch.softmax(top_k_logits.float() / temperature, dim=-1)
+    next_token = torch.multinomial(probs, num_samples=1)
+    # (B, 1)
+    return torch.gather(top_k_idx, -1, next_token)
@@ -0,0 +1,175 @@
+import copy
+import dataclasses
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model import Fp8Linear, ModelArgs, Transformers, quantize_linears_fp8, sample_top_k
+
+def small_args():
+    # GQA and pages smaller than the decoded length
+    return ModelArgs(dim=64, n_layers=2, n_heads=4, n_kv_heads=2, vocab_size=97, max_batch_size=2, max_seq_len=32,
+                     dtype=torch.float32, kv_page_size=4, kv_compact_interval=5)
+
+@torch.no_grad()
+def reference_forward(model: Transformers, tokens: torch.Tensor):
+    # full causal forward with complex RoPE, repeated kv heads and an explicit softmax, shape: (B, seq_len, vocab_size)
+    args = model.args
+    batch_size, seq_len = tokens.shape
+    head_dim = args.dim // args.n_heads
+    n_kv_heads = args.n_kv_heads
+    n_rep = args.n_heads // n_kv_heads
+
+    theta = 1.0 / (10000.0 ** (torch.arange(0, head_dim, 2).float() / head_dim))
+    freqs = torch.outer(torch.arange(seq_len).float(), theta)
+    freqs_complex = torch.polar(torch.ones_like(freqs), freqs)
+
+    def rope(x):
+        x_complex = torch.view_as_complex(x.reshape(*x.shape[:-1], -1, 2))
+        return torch.view_as_real(x_complex * freqs_complex[None, :, None, :]).reshape(x.shape)
+
+    def norm(x, weight):
+        return weight * x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + args.norm_eps)
+
+    mask = torch.full((seq_len, seq_len), float("-inf")).triu(1)
+    h = model.tok_embeddings.weight[tokens]
+    for layer in model.layers:
+        attention = layer.attention
+        x = norm(h, layer.attention_norm.weight)
+        xq, xk, xv = (x @ attention.wqkv.weight.T).split([args.n_heads * head_dim, n_kv_heads * head_dim, n_kv_heads * head_dim], dim=-1)
+        xq = rope(xq.reshape(batch_size, seq_len, args.n_heads, head_dim)).transpose(1, 2)
+        xk = rope(xk.reshape(batch_size, seq_len, n_kv_heads, head_dim)).repeat_interleave(n_rep, dim=2).transpose(1, 2)
+        xv = xv.reshape(batch_size, seq_len, n_kv_heads, head_dim).repeat_interleave(n_rep, dim=2).transpose(1, 2)
+        scores = F.softmax(xq @ xk.transpose(2, 3) / head_dim ** 0.5 + mask, dim=-1)
+        out = (scores @ xv).transpose(1, 2).reshape(batch_size, seq_len, -1) @ attention.wo.weight.T
+        # same as EncoderBlock: the feed forward block normalizes the input of the block
+        x_w1, x_v = (norm(h, layer.ffn_norm.weight) @ layer.feed_forward.w13.weight.T).chunk(2, dim=-1)
+        h = h + out + (F.silu(x_w1) * x_v) @ layer.feed_forward.w2.weight.T
+    return norm(h, model.norm.weight) @ model.output.weight.T
+
+@pytest.mark.parametrize("paged_kv_cache", [False, True])
+def test_decode_matches_reference(paged_kv_cache):
+    torch.manual_seed(0)
+    model = Transformers(dataclasses.replace(small_args(), paged_kv_cache=paged_kv_cache))
+    tokens = torch.randint(0, model.args.vocab_size, (2, 12))
+    expected = reference_forward(model, tokens)
+
+    for pos in range(tokens.shape[1]):
+        logits = model(tokens[:, pos:pos + 1], pos)
+        assert logits.shape == (2, 1, model.args.vocab_size)
+        torch.testing.assert_close(logits[:, 0], expected[:, pos], rtol=1e-4, atol=1e-4)
+
+    assert sample_top_k(logits, top_k=5).shape == (2, 1)
+
+@pytest.mark.parametrize("paged_kv_cache", [False, True])
+def test_decode_rows_at_different_positions(paged_kv_cache):
+    torch.manual_seed(0)
+    model = Transformers(dataclasses.replace(small_args(), paged_kv_cache=paged_kv_cache))
+    tokens = torch.randint(0, model.args.vocab_size, (2, 10))
+    new_tokens = torch.randint(0, model.args.vocab_size, (1, 6))
+    expected = reference_forward(model, tokens)
+    expected_new = reference_forward(model, new_tokens)
+
+    for pos in range(4):
+        model(tokens[:, pos:pos + 1], pos)
+    # the second sequence is done, a new one takes its row (and its pages with the paged kv cache)
+    model.free_kv_cache(1)
+    for step in range(new_tokens.shape[1]):
+        pos = 4 + step
+        step_tokens = torch.stack([tokens[0, pos], new_tokens[0, step]])[:, None]
+        logits = model(step_tokens, [pos, step])
+        torch.testing.assert_close(logits[0, 0], expected[0, pos], rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(logits[1, 0], expected_new[0, step], rtol=1e-4, atol=1e-4)
+
+def test_int8_kv_cache_decode_matches_reference():
+    torch.manual_seed(0)
+    model = Transformers(dataclasses.replace(small_args(), kv_cache_int8=True))
+    tokens = torch.randint(0, model.args.vocab_size, (2, 12))
+    expected = reference_forward(model, tokens)
+
+    for pos in range(tokens.shape[1]):
+        logits = model(tokens[:, pos:pos + 1], pos)
+        # the per row int8 quantization of the keys and values adds an error of a few 1e-3
+        torch.testing.assert_close(logits[:, 0], expected[:, pos], rtol=0, atol=1e-2)
+
+def test_decode_with_padded_cache_rows():
+    torch.manual_seed(0)
+    # head_dim 12 in float32 is a 48 byte row, padded to 64 bytes in the cache
+    model = Transformers(dataclasses.replace(small_args(), dim=48))
+    attention = model.layers[0].attention
+    assert (attention.head_dim, attention.cache_head_dim) == (12, 16)
+    tokens = torch.randint(0, model.args.vocab_size, (2, 12))
+    expected = reference_forward(model, tokens)
+
+    for pos in range(tokens.shape[1]):
+        logits = model(tokens[:, pos:pos + 1], pos)
+        torch.testing.assert_close(logits[:, 0], expected[:, pos], rtol=1e-4, atol=1e-4)
+
+def test_compaction_frees_pages_of_a_restarted_row():
+    torch.manual_seed(0)
+    model = Transformers(dataclasses.replace(small_args(), paged_kv_cache=True, kv_compact_interval=5))
+    tokens = torch.randint(0, model.args.vocab_size, (2, 16))
+    new_tokens = torch.randint(0, model.args.vocab_size, (1, 8))
+    expected = reference_forward(model, tokens)
+    expected_new = reference_forward(model, new_tokens)
+
+    # steps 1 to 8: both sequences own two pages
+    for pos in range(8):
+        model(tokens[:, pos:pos + 1], pos)
+    stale_page = model.seq_pages[1][1]
+    # the second row restarts from position 0 without free_kv_cache, the compaction of step 10 frees its second page
+    # and the first sequence takes it when it enters its fourth page (position 12)
+    for step in range(new_tokens.shape[1]):
+        pos = 8 + step
+        step_tokens = torch.stack([tokens[0, pos], new_tokens[0, step]])[:, None]
+        logits = model(step_tokens, [pos, step])
+        if model.n_steps == 10:
+            assert stale_page in model.free_pages
+        torch.testing.assert_close(logits[0, 0], expected[0, pos], rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(logits[1, 0], expected_new[0, step], rtol=1e-4, atol=1e-4)
+    assert model.seq_pages[0][3] == stale_page
+
+def test_fp8_linears_close_to_unquantized():
+    torch.manual_seed(0)
+    model = Transformers(small_args())
+    model_fp8 = quantize_linears_fp8(copy.deepcopy(model))
+    assert isinstance(model_fp8.layers[0].attention.wqkv, Fp8Linear)
+    tokens = torch.randint(0, model.args.vocab_size, (2, 8))
+
+    for pos in range(tokens.shape[1]):
+        logits = model(tokens[:, pos:pos + 1], pos)
+        logits_fp8 = model_fp8(tokens[:, pos:pos + 1], pos)
+        # e4m3 weights with 128 x 128 block scales, about 4% relative error on the logits
+        assert (logits_fp8 - logits).norm() / logits.norm() < 0.1
+
+def test_fp8_keeps_tied_output_head():
+    model = quantize_linears_fp8(Transformers(dataclasses.replace(small_args(), tie_word_embeddings=True)))
+    assert type(model.output) is nn.Linear
+    assert model.output.weight is model.tok_embeddings.weight
+    assert isinstance(model.layers[0].feed_forward.w2, Fp8Linear)
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA graphs need a GPU")
+def test_cuda_graph_replay_matches_eager():
+    torch.manual_seed(0)
+    args = dataclasses.replace(small_args(), device="cuda")
+    model = Transformers(args)
+    model_graph = Transformers(dataclasses.replace(args, use_cuda_graphs=True))
+    model_graph.load_state_dict(model.state_dict())
+    tokens = torch.randint(0, args.vocab_size, (2, 10), device="cuda")
+
+    def check(step_tokens, start_pos):
+        expected = model(step_tokens, start_pos)
+        logits = model_graph(step_tokens, start_pos)
+        torch.testing.assert_close(logits, expected, rtol=1e-4, atol=1e-4)
+
+    # both rows at the same position, crossing the page boundary at position 4
+    for pos in range(6):
+        check(tokens[:, pos:pos + 1], pos)
+    # the second row is freed and restarts from 0: rows at different positions, crossing a page boundary at 8
+    model.free_kv_cache(1)
+    model_graph.free_kv_cache(1)
+    for step in range(4):
+        check(tokens[:, 6 + step:7 + step], [6 + step, step])
+    assert set(model_graph.cuda_graphs) == {(2, 1), (2, 2), (2, 3)}